@@ -44,7 +44,7 @@ AMILOGIN="fedora"             # give the username associated with the AMI, it
 
 # Defines the aws command
 REGION="eu-central-1" #the region where to start the image
-AWS_CMD="aws --region $REGION --color on ec2"
+AWS_CMD="aws --region $REGION --color auto ec2"
 
 # The name of the credentials to access the instance
 KEYNAME="tlavocat_keys"
@@ -52,6 +52,11 @@ KEYNAME="tlavocat_keys"
 # Private credentials location to connect to the instance
 PEMLOCATION="$HOME/.ssh/tlavocat_keys.pem"
 
+# Socket of the shared ssh connection to the instance, all the commands sent to
+# it are multiplexed over a single connection instead of each doing a new
+# handshake
+SSHCONTROLPATH="$HOME/.ssh/node_reservation-%C"
+
 # A list of git remotes to pull from
 # Use https remotes as the instance will not have access to your ssh key
 # Also, the url is parsed to extract the name of the project to execute the
@@ -143,18 +148,26 @@ GREEN='\033[0;32m'
 YELLOW='\033[0;33m'
 NC='\033[0m' # No Color
 BOLD='\033[1m' # No Color BOLD
+# Colors are only emitted on a terminal, and never if NO_COLOR is set
+function _colorecho(){
+    if [ -t 1 ] && [ -z "$NO_COLOR" ]; then
+        echo -e "$1$2${NC}"
+    else
+        echo -e "$2"
+    fi
+}
 function _boldecho(){
-    echo -e "${BOLD}$1${NC}"
+    _colorecho "$BOLD" "$1"
 }
 function _greenecho(){
-    echo -e "${GREEN}$1${NC}"
+    _colorecho "$GREEN" "$1"
 }
 function _redecho(){
-    echo -e "${RED}$1${NC}"
+    _colorecho "$RED" "$1"
 }
 
 function _yellowecho(){
-    echo -e "${YELLOW}$1${NC}"
+    _colorecho "$YELLOW" "$1"
 }
 
 # Checks whether the previous command was a success and if it was not prints a
@@ -201,19 +214,36 @@ function _check_restult_print_ssh(){
     fi
 }
 
+# Run a command on the reserved node, extra arguments are passed to ssh
+function _node_ssh(){
+    ssh -oStrictHostKeyChecking=no -i "$PEMLOCATION" \
+        -oControlMaster=auto -oControlPath="$SSHCONTROLPATH" -oControlPersist=10m \
+        "$AMILOGIN@$AWSHOST" "$@"
+}
+
 # Wait until ssh is up on the remote node
 function _instanceWaitSSH() {
     local HOST="$1"
-    for LOOP_COUNTER in {0..30}; do
-        if ssh-keyscan "$HOST" > /dev/null 2>&1; then
+    local INTERVAL=5
+    # Give the node a fixed 5 minutes to come up, however long each probe takes
+    local DEADLINE=$((SECONDS + 300))
+    local LOOP_COUNTER=0
+    while true; do
+        local START=$SECONDS
+        if ssh-keyscan -T $INTERVAL "$HOST" > /dev/null 2>&1; then
             _greenecho "SSH is up!"
             break
-        elif (($LOOP_COUNTER == 29)); then
+        elif ((SECONDS >= DEADLINE)); then
             _redecho "SSH is not up... termintating"
             return 1
         else
-            _yellowecho "Retrying in 5 seconds... $LOOP_COUNTER"
-            sleep 5
+            # ssh-keyscan may have already waited for its timeout, only
+            # sleep for what is left of the retry interval
+            local REMAINING=$((INTERVAL - (SECONDS - START)))
+            ((REMAINING < 0)) && REMAINING=0
+            _yellowecho "Retrying in $REMAINING seconds... $LOOP_COUNTER"
+            sleep $REMAINING
+            LOOP_COUNTER=$((LOOP_COUNTER + 1))
         fi
     done
 }
@@ -221,8 +251,9 @@ function _instanceWaitSSH() {
 function node_reserve(){
     # Reserve an instance with a root disk of 30GB
     _boldecho "Reserving an instance"
-    export AWS_INSTANCE_ID=$(jq -r '.Instances[].InstanceId' \
-        <($AWS_CMD run-instances \
+    # Let the aws cli extract the fields itself (--query) instead of
+    # piping its JSON output through jq
+    export AWS_INSTANCE_ID=$($AWS_CMD run-instances \
         --key-name "$KEYNAME" \
         --image-id $AMIID \
         --count 1 \
@@ -236,7 +267,8 @@ service sshd restart
 EOF
             ) \
         --security-group-ids sg-08a1ec985f7f58d6e \
-        ) \
+        --query 'Instances[].InstanceId' \
+        --output text \
     )
     _greenecho "The instance is reserved $AWS_INSTANCE_ID"
     _boldecho "Wait for running state"
@@ -245,10 +277,10 @@ EOF
 
     # get the hostname
     _boldecho "Get the host's ip"
-    export AWSHOST=$(jq -r '.Reservations[].Instances[].PublicIpAddress' \
-        <( \
-        $AWS_CMD describe-instances --instance-ids "$AWS_INSTANCE_ID" \
-        ) \
+    export AWSHOST=$($AWS_CMD describe-instances \
+        --instance-ids "$AWS_INSTANCE_ID" \
+        --query 'Reservations[].Instances[].PublicIpAddress' \
+        --output text \
     )
     _greenecho "Instance's IP $AWSHOST"
     _boldecho "Wait for ssh to be up"
@@ -256,12 +288,12 @@ EOF
 
     # Check access with ssh
     _boldecho Check access with ssh
-    ssh -oStrictHostKeyChecking=no -i $PEMLOCATION $AMILOGIN@$AWSHOST -t echo "OK" &>/dev/null
+    _node_ssh -t echo "OK" &>/dev/null
     _check_restult_terminate || return 1
 
     # Install first packages
     _boldecho "Performing base package installation"
-    ssh -oStrictHostKeyChecking=no -i $PEMLOCATION $AMILOGIN@$AWSHOST -t \
+    _node_ssh -t \
         sudo dnf -q -y install htop \
         pylint \
         skopeo \
@@ -281,21 +313,40 @@ EOF
     _check_restult_terminate || return 1
 
     # Install the sources
-    _boldecho "Cloning git repos and installing"
+    # Use blobless clones: the server filters out historical file contents,
+    # which are fetched lazily if ever needed (e.g. by git log -p)
+    # The clones are independent so run them concurrently in a single ssh
+    # session, the installations depend on each other and stay sequential
+    _boldecho "Cloning git repos"
+    _node_ssh 'bash -s' << EOF
+pids=()
+for remote in ${GITREMOTES[*]}; do
+    echo "Cloning git \$remote"
+    git clone -q --filter=blob:none "\$remote" &
+    pids+=(\$!)
+done
+status=0
+for pid in "\${pids[@]}"; do
+    wait "\$pid" || status=1
+done
+exit \$status
+EOF
+    _check_restult_terminate || return 1
+
+    _boldecho "Installing git repos"
     for t in ${GITREMOTES[@]}; do
-        _boldecho "Cloning git $t"
-        ssh -oStrictHostKeyChecking=no -i $PEMLOCATION $AMILOGIN@$AWSHOST -t git clone $t
-        _check_restult_terminate || return 1
         IFS='/' read -r -a split <<< "$t"
         IFS='.' read -r -a split <<< ${split[-1]}
         _boldecho "perform install for ${split}[0]"
-        ${split[0]}_install "ssh -oStrictHostKeyChecking=no -i $PEMLOCATION $AMILOGIN@$AWSHOST -t" ${split[0]} || return 1
+        ${split[0]}_install "_node_ssh -t" ${split[0]} || return 1
     done
 
     # Append helper commands in bash_history to have them on ctrl+r
-    ssh -oStrictHostKeyChecking=no -i $PEMLOCATION $AMILOGIN@$AWSHOST -t " echo \"journalctl -f -u osbuild-worker@1.service\" >> ~/.bash_history"
-    ssh -oStrictHostKeyChecking=no -i $PEMLOCATION $AMILOGIN@$AWSHOST -t " echo \"journalctl -f -u osbuild-composer.service\" >> ~/.bash_history"
-    ssh -oStrictHostKeyChecking=no -i $PEMLOCATION $AMILOGIN@$AWSHOST -t " echo \"make build; sudo systemctl disable --now osbuild-composer.service osbuild-composer-api.socket osbuild-worker@1.service && sudo make install && sudo systemctl enable --now osbuild-composer-api.socket osbuild-worker@1.service\" >> ~/.bash_history"
+    _node_ssh 'cat >> ~/.bash_history' << 'EOF'
+journalctl -f -u osbuild-worker@1.service
+journalctl -f -u osbuild-composer.service
+make build; sudo systemctl disable --now osbuild-composer.service osbuild-composer-api.socket osbuild-worker@1.service && sudo make install && sudo systemctl enable --now osbuild-composer-api.socket osbuild-worker@1.service
+EOF
 
     # Print a reminder to connect and terminate the instance
     _greenecho "Installation done on $AWSHOST. To terminate instance later enter the command below"
@@ -310,25 +361,29 @@ EOF
 #
 # First, the hash of the top commit is fetched on the remote.
 # Second, the patch between this hash and local state is produced
-# Third, the patch is applied
+# Third, the patch is sent over ssh and applied
 #
 # The remote machine will be deployed with an up-to-date origin/main, then if
 # your local state is behind what's on the repo, you will be prompt to update
 # your code base. (Because the commit on the remote does not exit on your local
 # machine, then, you can't produce a patch !)
 function node_uploadiff(){
-    ssh_base="ssh -q -oStrictHostKeyChecking=no -i $PEMLOCATION $AMILOGIN@$AWSHOST -t"
-    # get the project name we are in
-    git status &> /dev/null
+    # No -t: none of these commands is interactive and not allocating a pty
+    # keeps the captured output free of carriage returns
+    ssh_base="_node_ssh -q"
+    # get the project name we are in, reading the origin url also fails when
+    # we are not in a git folder, no need for a separate git status
+    local origin_url
+    origin_url=$(git config --local remote.origin.url 2> /dev/null)
     if [ $? -gt 0 ]; then
-        _redecho "Are you in a git folder ?"
+        _redecho "Are you in a git folder with an origin remote ?"
         return 1
     fi
-    local project=$(git config --local remote.origin.url|sed -n 's#.*/\([^.]*\)\.git#\1#p')
+    local project=$(sed -n 's#.*/\([^.]*\)\.git#\1#p' <<< "$origin_url")
 
     # get the remote commit hash
-    local remote_hash=$($ssh_base "cd $project && git rev-parse HEAD")
-    remote_hash=${remote_hash/$'\r'/}
+    local remote_hash
+    remote_hash=$($ssh_base "cd $project && git rev-parse HEAD")
     if [ $? -gt 0 ]; then
         _redecho "There is an error, maybe you are in the wrong git on the local machine ?"
         return 1
@@ -347,23 +402,15 @@ function node_uploadiff(){
         return 1
     fi
 
-    # reset hard remote
-    $ssh_base "cd $project && git reset --hard ${remote_hash}" &> /dev/null
-    if [ $? -gt 0 ]; then
-        _redecho "can't reset remote"
-        return 1
-    fi
-
-    # clean
-    $ssh_base "cd $project && git clean -f -d" &> /dev/null
+    # reset hard and clean remote in a single ssh command
+    $ssh_base "cd $project && git reset --hard ${remote_hash} && git clean -f -d" &> /dev/null
     if [ $? -gt 0 ]; then
-        _redecho "can't clean remote"
+        _redecho "can't reset and clean remote"
         return 1
     fi
 
-    # send the patch to the remote
-    rsync -e "ssh -i ${PEMLOCATION}" -aAX /tmp/patchforremote $AMILOGIN@${AWSHOST}:/tmp/patchforremote
-    $ssh_base "cd $project && git apply /tmp/patchforremote"
+    # stream the patch to git apply on the remote through the ssh connection
+    $ssh_base "cd $project && git apply" < /tmp/patchforremote
     if [ $? -gt 0 ]; then
         _redecho "can't apply patch"
         return 1
@@ -375,21 +422,21 @@ function node_print_reservation_infos(){
     _boldecho "reservation details"
     echo "ID $AWS_INSTANCE_ID"
     echo "IP $AWSHOST"
-    SCRIPTPATH="$( cd -- "$(dirname "$0")" >/dev/null 2>&1 ; pwd -P )"
     _boldecho "to have access to the commands from another terminal:"
     echo "export AWS_INSTANCE_ID=$AWS_INSTANCE_ID; export AWSHOST=$AWSHOST"
 }
 
 function node_open_tmux(){
-    ssh -oStrictHostKeyChecking=no -i $PEMLOCATION $AMILOGIN@$AWSHOST -t tmux
+    _node_ssh -t tmux
 }
 
 function node_attach_tmux(){
-    ssh -oStrictHostKeyChecking=no -i $PEMLOCATION $AMILOGIN@$AWSHOST -t tmux attach
+    _node_ssh -t tmux attach
 }
 
 function node_terminate(){
     echo "Terminate instance $AWS_INSTANCE_ID"
+    _node_ssh -O exit &>/dev/null
     $AWS_CMD terminate-instances --instance-ids $AWS_INSTANCE_ID
     _check_restult || return 1
 }
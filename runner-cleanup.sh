@@ -8,21 +8,30 @@
 
 
 # Look only for JOBS that have a terraform lock file in them
-TF_FILES=$(find . -iname ".terraform.lock.hcl")
+mapfile -t RUNNER_FOLDERS < <(find . -iname ".terraform.lock.hcl" -printf '%h\n')
 # Anything older than 5 hours should have timed out and be destroyed
 HOURS_BACK=5
 TIME_TO_DELETE=$(date -d "- $HOURS_BACK hours" +%s)
+# The job folder is the numbered top-level folder, e.g. ./1234/
+JOB_FOLDER_RE='\./[0-9]*/'
 
-for FILE  in $TF_FILES; do
-    RUNNER_FOLDER=$(echo "$FILE" | sed -r 's/(\/.terraform.lock.hcl)//')
-    JOB_FOLDER=$(echo "$FILE" | grep -Eo '.\/[0-9]*\/')
-    MODIFIED_TIME=$(stat "$RUNNER_FOLDER" --format %Y)
-    if [[ $MODIFIED_TIME < $TIME_TO_DELETE ]];then
-        VM_IP=$(jq -r .outputs.ip_address.value[0] terraform.tfstate)
+if [[ ${#RUNNER_FOLDERS[@]} -eq 0 ]]; then
+    exit 0
+fi
+
+# Get the modification time of all runner folders with a single stat call.
+# The list is read from fd 3 so terraform can't consume it from stdin.
+while read -r -u 3 MODIFIED_TIME RUNNER_FOLDER; do
+    # Match in-shell instead of spawning echo | grep per runner
+    [[ $RUNNER_FOLDER/ =~ $JOB_FOLDER_RE ]]
+    JOB_FOLDER=${BASH_REMATCH[0]}
+    if [[ $MODIFIED_TIME -lt $TIME_TO_DELETE ]];then
         pushd "$RUNNER_FOLDER" || exit
+        # Read the state of this runner, not one from the current directory
+        VM_IP=$(jq -r '.outputs.ip_address.value[0]' terraform.tfstate)
         terraform destroy -auto-approve
         popd || exit
         ssh-keygen -R "$VM_IP"
         rm -rf "$JOB_FOLDER"
     fi
-done
+done 3< <(stat --format '%Y %n' -- "${RUNNER_FOLDERS[@]}")
@@ -1,11 +1,21 @@
 #!/usr/bin/python3
 import argparse
 import contextlib
+import gzip
+import os
+import re
+import shutil
 import subprocess
+import tarfile
 import tempfile
+import urllib.error
 import urllib.request
+import zlib
 from datetime import datetime
 
+# The %changelog line including its line ending (LF or CRLF), if any
+CHANGELOG_RE = re.compile(r"^%changelog\r?(?:\n|\Z)", re.MULTILINE)
+
 
 def read_file(path) -> str:
     """
@@ -15,6 +25,52 @@ def read_file(path) -> str:
         return f.read()
 
 
+@contextlib.contextmanager
+def replaced_file(path: str, mode: str = "w", **kwargs):
+    """
+    Open a uniquely named temporary file next to the given path for writing.
+    Once the block finishes, the temporary file atomically replaces the path.
+    On error the temporary file is removed and the path is left untouched.
+    """
+    directory = os.path.dirname(path) or "."
+    with tempfile.NamedTemporaryFile(mode, dir=directory, delete=False, **kwargs) as f:
+        try:
+            yield f
+            f.flush()
+            if os.path.exists(path):
+                shutil.copymode(path, f.name)
+            os.replace(f.name, path)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+
+
+def write_file(path, content: str):
+    """
+    Atomically replace the file on the given path with the given content.
+    """
+    with replaced_file(path, encoding="utf-8") as f:
+        f.write(content)
+
+
+def is_complete_tarball(path: str, member: str) -> bool:
+    """
+    Return whether the gzipped tarball on the given path exists, decompresses
+    to the end with a valid checksum and contains the given member.
+    """
+    try:
+        # tarfile stops at the end-of-archive block, before the gzip trailer,
+        # so decompress the whole stream to have its CRC and size verified
+        with gzip.open(path) as f:
+            while f.read(1 << 20):
+                pass
+        with tarfile.open(path) as tarball:
+            tarball.getmember(member)
+    except (OSError, EOFError, KeyError, tarfile.TarError, zlib.error):
+        return False
+    return True
+
+
 def download_github_release_tarball(user: str, project: str, version: str) -> str:
     """
     Download a github release tarball of the given project.
@@ -23,23 +79,43 @@ def download_github_release_tarball(user: str, project: str, version: str) -> st
     tarball_url = f"{project_url}/archive/v{version}.tar.gz"
 
     local_path = f"{project}-{version}.tar.gz"
-    urllib.request.urlretrieve(
-        tarball_url,
-        local_path
-    )
+
+    # The tarball of a release never changes, so reuse the one left by a
+    # previous run, unless it is truncated or otherwise broken
+    if is_complete_tarball(local_path, f"{project}-{version}/{project}.spec"):
+        return local_path
+
+    with urllib.request.urlopen(tarball_url) as response, replaced_file(local_path, "wb") as f:
+        shutil.copyfileobj(response, f, length=1 << 20)
+        # Unlike urlretrieve, copyfileobj doesn't notice a connection that was
+        # closed early, check the size while the partial file can be dropped
+        size = f.tell()
+        expected = response.headers.get("Content-Length")
+        if expected is not None and size < int(expected):
+            raise urllib.error.ContentTooShortError(
+                f"retrieval incomplete: got only {size} out of {expected} bytes", None)
 
     return local_path
 
 
-@contextlib.contextmanager
-def extracted_tarball(path: str):
+def read_file_from_tarball(path: str, member: str) -> str:
     """
-    Extract a tarball into a temporary directory.
-    Yields the temporary directory.
+    Return the content of a single file inside the tarball on the given path,
+    without extracting the rest of the archive.
     """
-    with tempfile.TemporaryDirectory() as tempdir:
-        subprocess.run(["tar", "-xf", path, "--directory", tempdir], check=True)
-        yield tempdir
+    with tarfile.open(path) as tarball:
+        with tarball.extractfile(member) as f:
+            return f.read().decode("utf-8")
+
+
+def find_changelog(specfile: str) -> re.Match:
+    """
+    Find the %changelog directive in the given specfile.
+    """
+    match = CHANGELOG_RE.search(specfile)
+    if not match:
+        raise ValueError("%changelog not found in the specfile")
+    return match
 
 
 def merge_specfiles(upstream: str, downstream: str, version: str, author: str):
@@ -47,12 +123,9 @@ def merge_specfiles(upstream: str, downstream: str, version: str, author: str):
     Merge the upstream specfile with the changelog from downstream and add a new
     changelog entry.
     """
-    upstream_spec_lines = upstream.splitlines()
-    downstream_spec_lines = downstream.splitlines()
-
     # Find where changelog starts in both specfiles
-    changelog_start_in_up_spec = upstream_spec_lines.index("%changelog")
-    changelog_start_in_down_spec = downstream_spec_lines.index("%changelog")
+    changelog_in_up_spec = find_changelog(upstream)
+    changelog_in_down_spec = find_changelog(downstream)
 
     # Create a new changelog entry
     date = datetime.now().strftime("%a %b %d %Y")
@@ -66,11 +139,16 @@ def merge_specfiles(upstream: str, downstream: str, version: str, author: str):
     # Firstly, let's take upstream spec file including the %changelog directory
     # Then, put the newly created changelog entry
     # Finally, put there the changelog from the downstream spec file
-    merged_lines = upstream_spec_lines[:changelog_start_in_up_spec + 1] + \
-                   changelog.splitlines() + \
-                   downstream_spec_lines[changelog_start_in_down_spec + 1:]
+    upstream_head = upstream[:changelog_in_up_spec.end()]
+    if not upstream_head.endswith("\n"):
+        upstream_head += "\n"
+
+    merged = upstream_head + \
+        changelog + \
+        downstream[changelog_in_down_spec.end():]
 
-    return "\n".join(merged_lines) + "\n"
+    # Always write LF line endings with a single trailing newline
+    return "\n".join(merged.splitlines()) + "\n"
 
 
 def update_distgit(user: str, project: str, version: str, author: str, pkgtool: str, release: str):
@@ -79,24 +157,25 @@ def update_distgit(user: str, project: str, version: str, author: str, pkgtool:
     """
     specfile = f"{project}.spec"
 
-    tarball = download_github_release_tarball(user, project, version)
-
+    # Read the downstream specfile first, so running outside of a dist-git
+    # clone fails before anything is downloaded
     old_downstream_specfile = read_file(specfile)
 
-    with extracted_tarball(tarball) as path:
-        upstream_specfile = read_file(f"{path}/{project}-{version}/{specfile}")
+    tarball = download_github_release_tarball(user, project, version)
+
+    upstream_specfile = read_file_from_tarball(tarball, f"{project}-{version}/{specfile}")
 
     new_downstream_specfile = merge_specfiles(upstream_specfile,
                                               old_downstream_specfile,
                                               version,
                                               author)
 
-    with open(specfile, "w", encoding="utf-8") as f:
-        f.write(new_downstream_specfile)
+    write_file(specfile, new_downstream_specfile)
 
     release_arg = ["--release", release] if release else []
 
     subprocess.check_call([pkgtool, *release_arg, "new-sources", tarball])
+
     subprocess.check_call(["git", "add", ".gitignore", specfile, "sources"])
 
     commit_message = f"Update to {version}"
@@ -124,11 +203,17 @@ if __name__ == "__main__":
     if args.pkgtool not in ["fedpkg", "centpkg", "rhpkg"]:
         raise RuntimeError("--pkgtool must be fedpkg, centpkg, or rhpkg!")
 
+    # Resolve the tool once up-front, so a missing one is reported before the
+    # tarball is downloaded
+    pkgtool_path = shutil.which(args.pkgtool)
+    if pkgtool_path is None:
+        raise RuntimeError(f"{args.pkgtool} not found in PATH!")
+
     update_distgit(
         "osbuild",
         args.project,
         args.version,
         args.author,
-        args.pkgtool,
+        pkgtool_path,
         args.release,
     )